@@ -1,148 +1,379 @@
+"""Compare a migrated postgres server to its source.
+
+pandas, SQLAlchemy and the comparison modules are imported inside the
+commands that use them, so --help and the light commands start quickly.
+"""
+from __future__ import annotations
+
+import argparse
 import os
+import pickle
+import sys
 from datetime import date
+from glob import glob
 from time import perf_counter
-from typing import Dict 
-import pandas as pd
-from sqlalchemy import create_engine
-from sqlalchemy.engine.base import Connection
-from utils.objecs_comparison import(
-    compare_row_counts,
-    compare_views,
-    compare_columns,
-    compare_triggers,
-    compare_usage_privileges,
-    compare_sequences,
-    compare_functions,
-    compare_procedures,
-    compare_foreign_data_wrappers,
-    compare_extensions,
-)
-from utils.schemas import q_database_list
+from typing import TYPE_CHECKING, Dict, List, Optional, Tuple
+
+if TYPE_CHECKING:
+    import pandas as pd
+    from sqlalchemy.engine.base import Connection
+
 MIGRATION_SERVER = ""
+OUTPUTS_DIR = f"{os.path.dirname(os.path.abspath(__file__))}/outputs"
+RESULTS_DIR = f"{OUTPUTS_DIR}/results"
+ENV_PREFIX_SOURCE = "source"
+ENV_PREFIX_TARGET = "target"
+# row hashes and fingerprints compare values as text, so pin the settings that
+# change how timestamps, intervals and floats are printed on both servers
+SESSION_OPTIONS = (
+    "-c TimeZone=UTC -c DateStyle=ISO,MDY -c IntervalStyle=postgres -c extra_float_digits=3")
 
 def get_db_connection(database: str, env_var_prefix: str) -> Connection:
-    """Connect to a postgres database and return a sqlalchemy connection object"""    
-    pg_uri = f"postgresql://{os.environ.get(f'{env_var_prefix}_user')}:{os.environ.get(f'{env_var_prefix}_password')}@{os.environ.get(f'{env_var_prefix}_server')}:5432/{database}?sslmode=require"    engine = create_engine(pg_uri, pool_use_lifo=True, pool_recycle=300)
+    """Connect to a postgres database and return a sqlalchemy connection object"""
+    from sqlalchemy import create_engine
+
+    pg_uri = f"postgresql://{os.environ.get(f'{env_var_prefix}_user')}:{os.environ.get(f'{env_var_prefix}_password')}@{os.environ.get(f'{env_var_prefix}_server')}:5432/{database}?sslmode=require"
+    engine = create_engine(
+        pg_uri,
+        pool_use_lifo=True,
+        pool_recycle=300,
+        connect_args={"options": SESSION_OPTIONS},
+    )
     conn = engine.connect()
     return conn
 
 def get_comparison_connections(
     database: str, source_env_var_prefix: str, target_env_var_prefix: str):
-    """Get connection objects for source and target DB to do comparison on"""    
+    """Get connection objects for source and target DB to do comparison on"""
     try:
         source_conn = get_db_connection(database, source_env_var_prefix)
         target_conn = get_db_connection(database, target_env_var_prefix)
-        global MIGRATION_SERVER        
+        global MIGRATION_SERVER
         MIGRATION_SERVER = os.environ.get(f"{source_env_var_prefix}_server")
-        return source_conn, target_conn    
+        return source_conn, target_conn
     except Exception as err:
         print(f"Connection error: {err}")
 
+def get_env_seconds(env_var: str) -> Optional[float]:
+    """Read a duration in seconds from the environment, None if unset or 0"""
+    seconds = float(os.environ.get(env_var) or 0)
+    return seconds if seconds > 0 else None
+
+def get_databases_list(conn: Connection) -> List[str]:
+    """Get the names of the databases to validate on the server"""
+    from utils.schemas import q_database_list
+
+    return [row[0] for row in conn.execute(q_database_list).fetchall()]
+
 def generate_report(
-    summary_df: pd.DataFrame, detail_compare_dict: Dict[str, pd.DataFrame]
+    run_id: str,
+    summary_df: pd.DataFrame,
+    detail_compare_dict: Dict[str, List[pd.DataFrame]],
 ):
-    """Ouput the validation results to an excel file"""    
-    file_name = f"{os.path.dirname(__file__)}/outputs/{MIGRATION_SERVER}_validation_{date.today()}.xlsx"    
+    """Ouput the validation results of a run to an excel file named after the run"""
+    import pandas as pd
+
+    os.makedirs(OUTPUTS_DIR, exist_ok=True)
+    file_name = f"{OUTPUTS_DIR}/{run_id}_validation.xlsx"
     writer = pd.ExcelWriter(file_name)
     summary_df.to_excel(
         writer,
         sheet_name="Summary_Comparison",
     )
     for db_key in detail_compare_dict:
-        df_row_check = 0        
+        df_row_check = 0
         for df in detail_compare_dict[db_key]:
-            start = df_row_check            
             db_df = pd.DataFrame(df)
-            start = df_row_check            
-            db_df.to_excel(writer, sheet_name=db_key, startrow=start)
-            df_row_check += len(df) + 7        
-            df_row_check = 0    
-            writer.close()
+            db_df.to_excel(writer, sheet_name=db_key, startrow=df_row_check)
+            df_row_check += len(df) + 7
+    writer.close()
     print(f"Report has been generated to : {file_name}")
 
-def main():
-    """ "Perform comparison of the source DB vs target DB"""    
+def compare_database(
+    database: str, env_prefix_source: str, env_prefix_target: str
+) -> Tuple[Dict[str, bool], List[pd.DataFrame]]:
+    """Perform comparison of one source DB vs its target DB"""
+    from utils.objecs_comparison import (
+        compare_row_counts,
+        compare_views,
+        compare_columns,
+        compare_triggers,
+        compare_usage_privileges,
+        compare_sequences,
+        compare_functions,
+        compare_procedures,
+        compare_foreign_data_wrappers,
+        compare_extensions,
+        compare_sampled_rows,
+        compare_column_fingerprints,
+        compare_definitions,
+    )
+
+    summary_compare = {}
+    timeout_seconds = get_env_seconds("statement_timeout_seconds")
+    time_budget = get_env_seconds("database_time_budget_seconds")
+    deadline = perf_counter() + time_budget if time_budget else None
+    source_conn, target_conn = get_comparison_connections(
+        database, env_prefix_source, env_prefix_target)
+    # catalog checks are cheap, run them before the table scans use up the budget
+    views_compared, views_check = compare_views(source_conn, target_conn)
+    columns_compared, columns_check = compare_columns(
+        source_conn, target_conn)
+    triggers_compared, triggers_check = compare_triggers(
+        source_conn, target_conn)
+    (
+        usage_privileges_compared,
+        usage_privileges_check,
+    ) = compare_usage_privileges(source_conn, target_conn)
+    sequences_compared, sequences_check = compare_sequences(
+        source_conn, target_conn)
+    functions_compared, functions_check = compare_functions(
+        source_conn, target_conn)
+    procedures_compared, procedures_check = compare_procedures(
+        source_conn, target_conn)
+    fdw_compared, fdw_check = compare_foreign_data_wrappers(
+        source_conn, target_conn)
+    extensions_compared, extensions_check = compare_extensions(
+        source_conn, target_conn)
+    definitions_compared, definitions_check = compare_definitions(
+        source_conn, target_conn)
+    rows_compared, table_rows_check = compare_row_counts(
+        source_conn, target_conn, timeout_seconds, deadline)
+    sampled_rows_compared, sampled_rows_check = compare_sampled_rows(
+        source_conn,
+        target_conn,
+        sample_rows=int(os.environ.get("sample_rows_per_table", 10000)),
+        sample_seconds=float(os.environ.get("sample_seconds_per_table", 30)),
+        seed=int(os.environ.get("sample_seed", 42)),
+        timeout_seconds=timeout_seconds,
+        deadline=deadline,
+    )
+    (
+        column_fingerprints_compared,
+        column_fingerprints_check,
+    ) = compare_column_fingerprints(source_conn, target_conn, timeout_seconds, deadline)
+    detail_compare = [
+        rows_compared,
+        views_compared,
+        columns_compared,
+        triggers_compared,
+        usage_privileges_compared,
+        sequences_compared,
+        functions_compared,
+        procedures_compared,
+        fdw_compared,
+        extensions_compared,
+        sampled_rows_compared,
+        column_fingerprints_compared,
+        definitions_compared,
+    ]
+    summary_compare["table_row_counts_equal"] = table_rows_check
+    summary_compare["views_equal"] = views_check
+    summary_compare["columns_equal"] = columns_check
+    summary_compare["triggers_equal"] = triggers_check
+    summary_compare["usage_privileges_equal"] = usage_privileges_check
+    summary_compare["sequences_equal"] = sequences_check
+    summary_compare["functions_equal"] = functions_check
+    summary_compare["procedures_equal"] = procedures_check
+    summary_compare["foreign_data_wrapper_equal"] = fdw_check
+    summary_compare["extensions_equal"] = extensions_check
+    summary_compare["sampled_rows_equal"] = sampled_rows_check
+    summary_compare["column_fingerprints_equal"] = column_fingerprints_check
+    summary_compare["definitions_equal"] = definitions_check
+    source_conn.close()
+    target_conn.close()
+    return summary_compare, detail_compare
+
+def default_run_id() -> str:
+    """Results of one run are scoped to the source server and the date"""
+    return f"{os.environ.get(f'{ENV_PREFIX_SOURCE}_server')}_{date.today()}"
+
+def save_results(
+    run_id: str,
+    database: str,
+    summary_compare: Dict[str, bool],
+    detail_compare: List[pd.DataFrame],
+):
+    """Store the comparison results of one DB so the report command can pick them up
+
+    A failed comparison is stored with empty results, replacing any earlier
+    results of the DB in the same run.
+    """
+    results_dir = f"{RESULTS_DIR}/{run_id}"
+    os.makedirs(results_dir, exist_ok=True)
+    with open(f"{results_dir}/{database}.pkl", "wb") as results_file:
+        pickle.dump(
+            {
+                "server": os.environ.get(f"{ENV_PREFIX_SOURCE}_server"),
+                "run_id": run_id,
+                "database": database,
+                "summary": summary_compare,
+                "detail": detail_compare,
+            },
+            results_file,
+        )
+
+def load_results(
+    run_id: str,
+) -> Tuple[Dict[str, Dict[str, bool]], Dict[str, List[pd.DataFrame]]]:
+    """Load the stored comparison results of every DB of a run"""
     summary_compare_dict = {}
     detail_compare_dict = {}
-    env_prefix_source = "source"    
-    env_prefix_target = "target"    
-    try:
-        conn = get_db_connection("postgres", env_prefix_source)
-        databases_list = [
-            db            for db in pd.read_sql_query(q_database_list, conn)
-            .loc[:, "db_name"]
-            .to_list()
-        ]
-        for database in databases_list:
-            summary_compare_dict[database] = {}
-            print(f"Performing comparison of database: {database}")
-            try:
-                source_conn, target_conn = (
-                    source_conn,
-                    target_conn,
-                ) = get_comparison_connections(
-                    database, env_prefix_source, env_prefix_target                )
-                rows_compared, table_rows_check = compare_row_counts(
-                    source_conn, target_conn                )
-                views_compared, views_check = compare_views(source_conn, target_conn)
-                columns_compared, columns_check = compare_columns(
-                    source_conn, target_conn                )
-                triggers_compared, triggers_check = compare_triggers(
-                    source_conn, target_conn                )
-                (
-                    usage_privileges_compared,
-                    usage_privileges_check,
-                ) = compare_usage_privileges(source_conn, target_conn)
-                sequences_compared, sequences_check = compare_sequences(
-                    source_conn, target_conn                )
-                functions_compared, functions_check = compare_functions(
-                    source_conn, target_conn                )
-                procedures_compared, procedures_check = compare_procedures(
-                    source_conn, target_conn                )
-                fdw_compared, fdw_check = compare_foreign_data_wrappers(
-                    source_conn, target_conn                )
-                extensions_compared, extensions_check = compare_extensions(
-                    source_conn, target_conn                )
-                detail_compare_dict[database] = [
-                    rows_compared,
-                    views_compared,
-                    columns_compared,
-                    triggers_compared,
-                    usage_privileges_compared,
-                    sequences_compared,
-                    functions_compared,
-                    procedures_compared,
-                    fdw_compared,
-                    extensions_compared,
-                ]
-                summary_compare_dict[database][
-                    "table_row_counts_equal"] = table_rows_check                
-                summary_compare_dict[database]["views_equal"] = views_check                
-                summary_compare_dict[database]["columns_equal"] = columns_check                
-                summary_compare_dict[database]["triggers_equal"] = triggers_check                
-                summary_compare_dict[database][
-                    "usage_privileges_equal"] = usage_privileges_check                
-                summary_compare_dict[database]["sequences_equal"] = sequences_check                
-                summary_compare_dict[database]["functions_equal"] = functions_check                
-                summary_compare_dict[database]["procedures_equal"] = procedures_check                
-                summary_compare_dict[database]["foreign_data_wrapper_equal"] = fdw_check                
-                summary_compare_dict[database]["extensions_equal"] = extensions_check                
-                print(f"Comparison complete for database: {database} \n")
-
-                source_conn.close()
-                target_conn.close()
-            except Exception as err:
-                print(f"Could not do comparison for {database}. Error: {err}")
-    except Exception as err:
-        print(
-            f"Could not retrieve list of databases to validate from the source server. Error: {err}")
+    for results_path in sorted(glob(f"{RESULTS_DIR}/{run_id}/*.pkl")):
+        with open(results_path, "rb") as results_file:
+            results = pickle.load(results_file)
+        if results["run_id"] != run_id:
+            continue
+        summary_compare_dict[results["database"]] = results["summary"]
+        if results["detail"]:
+            detail_compare_dict[results["database"]] = results["detail"]
+    return summary_compare_dict, detail_compare_dict
+
+def write_report(
+    run_id: str,
+    summary_compare_dict: Dict[str, Dict[str, bool]],
+    detail_compare_dict: Dict[str, List[pd.DataFrame]],
+):
+    """Build the summary frame and output the validation results"""
+    import pandas as pd
+
     summary_df = pd.DataFrame.from_dict(summary_compare_dict, orient="index")
-    generate_report(summary_df, detail_compare_dict)
+    generate_report(run_id, summary_df, detail_compare_dict)
 
-if __name__ == "__main__":
+def list_databases(args: argparse.Namespace) -> int:
+    """Print the databases on the source server that would be validated"""
+    conn = get_db_connection("postgres", ENV_PREFIX_SOURCE)
+    for database in get_databases_list(conn):
+        print(database)
+    conn.close()
+    return 0
+
+def check_connectivity(args: argparse.Namespace) -> int:
+    """Check that the source and target servers accept connections"""
+    from sqlalchemy import text
+
+    failed = False
+    for env_prefix in (ENV_PREFIX_SOURCE, ENV_PREFIX_TARGET):
+        server = os.environ.get(f"{env_prefix}_server")
+        try:
+            conn = get_db_connection(args.database, env_prefix)
+            conn.execute(text("select 1;"))
+            conn.close()
+            print(f"{env_prefix} ({server}/{args.database}): OK")
+        except Exception as err:
+            failed = True
+            print(f"{env_prefix} ({server}/{args.database}): FAILED. Error: {err}")
+    return 1 if failed else 0
+
+def compare(args: argparse.Namespace) -> int:
+    """Perform comparison of the source DB vs target DB
+
+    Returns non-zero if the databases could not be listed or any database
+    could not be compared.
+    """
+    failed = False
+    summary_compare_dict = {}
+    detail_compare_dict = {}
+    databases_list = args.database
+    if not databases_list:
+        try:
+            conn = get_db_connection("postgres", ENV_PREFIX_SOURCE)
+            databases_list = get_databases_list(conn)
+            conn.close()
+        except Exception as err:
+            print(
+                f"Could not retrieve list of databases to validate from the source server. Error: {err}")
+            failed = True
+            databases_list = []
+    for database in databases_list:
+        summary_compare_dict[database] = {}
+        print(f"Performing comparison of database: {database}")
+        try:
+            (
+                summary_compare_dict[database],
+                detail_compare_dict[database],
+            ) = compare_database(database, ENV_PREFIX_SOURCE, ENV_PREFIX_TARGET)
+            save_results(
+                args.run_id,
+                database,
+                summary_compare_dict[database],
+                detail_compare_dict[database],
+            )
+            print(f"Comparison complete for database: {database} \n")
+        except Exception as err:
+            failed = True
+            save_results(args.run_id, database, {}, [])
+            print(f"Could not do comparison for {database}. Error: {err}")
+    if not args.no_report:
+        write_report(args.run_id, summary_compare_dict, detail_compare_dict)
+    return 1 if failed else 0
+
+def report(args: argparse.Namespace) -> int:
+    """Output the stored comparison results of earlier compare runs to an excel file"""
+    summary_compare_dict, detail_compare_dict = load_results(args.run_id)
+    if not summary_compare_dict:
+        print(f"No comparison results found for run: {args.run_id}")
+        return 1
+    write_report(args.run_id, summary_compare_dict, detail_compare_dict)
+    return 0
+
+def build_parser() -> argparse.ArgumentParser:
+    """Build the command line parser"""
+    parser = argparse.ArgumentParser(
+        description="Compare a migrated postgres server to its source. "
+        "Runs compare on all databases when no command is given.")
+    subparsers = parser.add_subparsers(dest="command")
+
+    list_parser = subparsers.add_parser(
+        "list-databases", help="list the databases on the source server to validate")
+    list_parser.set_defaults(func=list_databases)
+
+    connectivity_parser = subparsers.add_parser(
+        "check-connectivity", help="check connections to the source and target servers")
+    connectivity_parser.add_argument(
+        "--database", default="postgres", help="database to connect to (default: postgres)")
+    connectivity_parser.set_defaults(func=check_connectivity)
+
+    compare_parser = subparsers.add_parser(
+        "compare", help="compare source vs target databases and output the report")
+    compare_parser.add_argument(
+        "--database",
+        action="append",
+        help="database to compare, can be repeated (default: all databases on the source)")
+    compare_parser.add_argument(
+        "--no-report",
+        action="store_true",
+        help="only store the results for a later report command")
+    compare_parser.add_argument(
+        "--run-id",
+        default=default_run_id(),
+        help="run to store the results under (default: <source server>_<today>)")
+    compare_parser.set_defaults(func=compare)
+
+    report_parser = subparsers.add_parser(
+        "report", help="output the stored results of earlier compare runs to an excel file")
+    report_parser.add_argument(
+        "--run-id",
+        default=default_run_id(),
+        help="run to report the stored results of (default: <source server>_<today>)")
+    report_parser.set_defaults(func=report)
+    return parser
+
+def main(argv: Optional[List[str]] = None) -> int:
+    """Run the requested command, compare on all databases by default"""
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    if args.command is None:
+        args = parser.parse_args(["compare"])
+    if args.command != "compare":
+        return args.func(args)
     t1_start = perf_counter()
     print("Starting Validation\n\n")
-    main()
+    exit_code = args.func(args)
     t1_stop = perf_counter()
     print(
-        f"\n\nCompleted Validation. Elapsed time {round((t1_stop - t1_start)/60, 2)} mins")
\ No newline at end of file
+        f"\n\nCompleted Validation. Elapsed time {round((t1_stop - t1_start)/60, 2)} mins")
+    return exit_code
+
+if __name__ == "__main__":
+    sys.exit(main())
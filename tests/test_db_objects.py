@@ -0,0 +1,73 @@
+import unittest
+from unittest import mock
+
+import pandas as pd
+from sqlalchemy import create_engine, text
+
+from utils import db_objects
+from utils.db_objects import read_sql_categorical, share_categories
+
+ROWS = [
+    ("public", "orders", 1),
+    ("public", "customers", 2),
+    (None, None, None),
+    (None, None, None),
+    ("sales", "orders", 5),
+]
+
+
+class TestReadSqlCategorical(unittest.TestCase):
+    def setUp(self):
+        self.engine = create_engine("sqlite://")
+        self.conn = self.engine.connect()
+        self.conn.execute(
+            text("create table catalog (table_schema text, table_name text, position integer)"))
+        self.conn.execute(
+            text("insert into catalog values (:schema, :name, :position)"),
+            [{"schema": s, "name": n, "position": p} for s, n, p in ROWS],
+        )
+        # chunks of two rows: the third chunk holds only the last row, the second only NULLs
+        patcher = mock.patch.object(db_objects, "CATALOG_CHUNK_SIZE", 2)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(self.engine.dispose)
+        self.addCleanup(self.conn.close)
+
+    def read(self, where=""):
+        return read_sql_categorical(
+            text(f"select * from catalog {where} order by rowid"), self.conn)
+
+    def test_chunks_are_unioned(self):
+        catalog_df = self.read()
+        self.assertIsInstance(catalog_df.table_schema.dtype, pd.CategoricalDtype)
+        self.assertEqual(set(catalog_df.table_schema.cat.categories), {"public", "sales"})
+        self.assertEqual(
+            catalog_df.table_name.dropna().tolist(), ["orders", "customers", "orders"])
+        self.assertEqual(catalog_df.table_name.isna().sum(), 2)
+
+    def test_all_null_chunk_keeps_column_types(self):
+        catalog_df = self.read()
+        self.assertIsInstance(catalog_df.table_name.dtype, pd.CategoricalDtype)
+        self.assertEqual(catalog_df.position.dtype, "float64")
+        self.assertEqual(catalog_df.position.isna().tolist(), [False, False, True, True, False])
+
+    def test_empty_result_keeps_columns(self):
+        catalog_df = self.read("where 0")
+        self.assertTrue(catalog_df.empty)
+        self.assertEqual(catalog_df.columns.tolist(), ["table_schema", "table_name", "position"])
+
+    def test_shared_categories_merge_like_strings(self):
+        src_df = self.read("where table_schema = 'public'")
+        targ_df = self.read("where table_schema is not null")
+        expected = src_df.astype(object).merge(
+            targ_df.astype(object), how="outer", indicator=True)
+        share_categories(src_df, targ_df)
+        self.assertTrue(
+            src_df.table_name.cat.categories.equals(targ_df.table_name.cat.categories))
+        merged = src_df.merge(targ_df, how="outer", indicator=True)
+        self.assertEqual(
+            merged.astype(object).values.tolist(), expected.astype(object).values.tolist())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,71 @@
+import unittest
+
+from utils.objecs_comparison import mismatch_rate_upper_bound, normalize_definition
+
+
+class TestNormalizeDefinition(unittest.TestCase):
+    def test_case_and_whitespace_are_folded(self):
+        self.assertEqual(
+            normalize_definition("SELECT  id,\tName\n  FROM   orders", "public"),
+            ["select id, name", "from orders"],
+        )
+
+    def test_literals_and_quoted_identifiers_are_preserved(self):
+        self.assertEqual(
+            normalize_definition(
+                "SELECT 'It''s  A public.Literal', \"Mixed  Case\" FROM t", "public"),
+            ["select 'It''s  A public.Literal', \"Mixed  Case\" from t"],
+        )
+
+    def test_own_schema_and_pg_catalog_qualifiers_are_stripped(self):
+        self.assertEqual(
+            normalize_definition(
+                'SELECT pg_catalog.now() FROM public.orders JOIN "public".lines ON true\n'
+                "JOIN other.items ON true",
+                "public",
+            ),
+            ["select now() from orders join lines on true", "join other.items on true"],
+        )
+
+    def test_mixed_case_schema_keeps_unquoted_qualifier(self):
+        self.assertEqual(
+            normalize_definition('SELECT * FROM "Sales".orders JOIN sales.lines ON true', "Sales"),
+            ["select * from orders join sales.lines on true"],
+        )
+
+    def test_blank_lines_are_dropped(self):
+        self.assertEqual(
+            normalize_definition("SELECT 1\n\n   \nFROM t\n", "public"), ["select 1", "from t"])
+
+    def test_other_languages_are_left_verbatim(self):
+        definition = "CREATE FUNCTION public.f() LANGUAGE plpython3u AS $$\n\nreturn  'X'\n$$"
+        self.assertEqual(
+            normalize_definition(definition, "public", "plpython3u"), definition.splitlines())
+        self.assertEqual(
+            normalize_definition(definition, "public", "plpgsql"),
+            ["create function f() language plpython3u as $$", "return 'X'", "$$"],
+        )
+
+
+class TestMismatchRateUpperBound(unittest.TestCase):
+    def test_empty_sample_bounds_nothing(self):
+        self.assertEqual(mismatch_rate_upper_bound(0, 0), 1.0)
+
+    def test_clean_sample(self):
+        # Wilson bound with no mismatches is z^2 / (n + z^2)
+        self.assertAlmostEqual(mismatch_rate_upper_bound(0, 10000), 1.96**2 / (10000 + 1.96**2))
+
+    def test_bound_lies_above_observed_rate(self):
+        bound = mismatch_rate_upper_bound(5, 1000)
+        self.assertGreater(bound, 5 / 1000)
+        self.assertAlmostEqual(bound, 0.01165, places=5)
+
+    def test_all_mismatched(self):
+        self.assertAlmostEqual(mismatch_rate_upper_bound(10, 10), 1.0)
+
+    def test_bound_narrows_with_sample_size(self):
+        self.assertLess(mismatch_rate_upper_bound(10, 10000), mismatch_rate_upper_bound(1, 1000))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,41 @@
+import os
+import subprocess
+import sys
+import unittest
+
+ENTRYPOINT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "entrypoint.py")
+HEAVY_MODULES = {"pandas", "sqlalchemy", "openpyxl"}
+IMPORT_TIME_BUDGET_US = 200_000
+
+
+def get_help_imports():
+    """Run entrypoint.py --help under -X importtime, return {module: (cumulative us, top level)}"""
+    completed = subprocess.run(
+        [sys.executable, "-X", "importtime", ENTRYPOINT, "--help"],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    imports = {}
+    for line in completed.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line.split("|")
+        top_level = len(name) - len(name.lstrip()) == 1
+        imports[name.strip()] = (int(cumulative), top_level)
+    return imports
+
+
+class TestStartup(unittest.TestCase):
+    def test_help_does_not_import_heavy_modules(self):
+        imported = {name.split(".")[0] for name in get_help_imports()}
+        self.assertFalse(imported & HEAVY_MODULES)
+
+    def test_help_import_time_within_budget(self):
+        total_us = sum(
+            cumulative for cumulative, top_level in get_help_imports().values() if top_level)
+        self.assertLess(total_us, IMPORT_TIME_BUDGET_US)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,27 +1,165 @@
-from typing import Tuple
+from time import perf_counter
+from typing import List, Optional, Tuple
 
 import pandas as pd
+from pandas.api.types import union_categoricals
+from sqlalchemy import text
 from sqlalchemy.engine.base import Connection
+from sqlalchemy.exc import OperationalError
 from utils.schemas import (
+    q_column_types,
     q_columns,
+    DEFINITION_TOKEN_PATTERN,
+    NORMALIZED_LANGUAGES,
+    q_definition_digests,
+    q_definitions,
     q_extensions,
     q_fdw,
     q_functions,
+    q_primary_keys,
     q_procedures,
     q_sequences,
+    q_table_estimate,
     q_tables_list,
     q_triggers,
     q_usage_privileges,
     q_views
 )
+QUERY_CANCELED = "57014"  # sqlstate of a query cancelled by statement_timeout
+SYSTEM_SAMPLE_MIN_ROWS = 1_000_000
+# rough rows per 8kB page for sizing samples of tables that were never analyzed;
+# erring high keeps the sample small instead of scanning the whole table
+UNANALYZED_ROWS_PER_PAGE = 100
+SAMPLE_FETCH_SIZE = 1000
+SAMPLE_LOOKUP_BATCH_SIZE = 1000
+# postgres caps a select list at 1664 entries, fingerprints use 6 per column
+FINGERPRINT_MAX_COLUMNS = 250
+NUMERIC_TYPES = {"smallint", "integer", "bigint", "numeric", "real", "double precision"}
+# float sums depend on scan order, and Infinity cannot be cast to numeric before PG14
+EXACT_NUMERIC_TYPES = NUMERIC_TYPES - {"real", "double precision"}
+TEXT_TYPES = {"character varying", "character", "text"}
+ORDERED_TYPES = NUMERIC_TYPES | TEXT_TYPES | {
+    "date",
+    "time without time zone",
+    "time with time zone",
+    "timestamp without time zone",
+    "timestamp with time zone",
+    "interval",
+}
+CATALOG_CHUNK_SIZE = 50000
+FINGERPRINT_METRICS = ["null_count", "min_value", "max_value", "value_sum", "length_sum", "hash_sum"]
+
+def read_sql_categorical(query, conn: Connection) -> pd.DataFrame:
+    """Read a catalog query chunk by chunk, storing text columns as categoricals
+
+    The result is streamed from a server-side cursor, so only one chunk of
+    plain Python strings is held at a time.
+    """
+    chunks = []
+    result = conn.execution_options(stream_results=True).execute(query)
+    columns = list(result.keys())
+    while True:
+        rows = result.fetchmany(CATALOG_CHUNK_SIZE)
+        if not rows:
+            break
+        chunk = pd.DataFrame(rows, columns=columns)
+        text_columns = chunk.select_dtypes(include="object").columns
+        chunks.append(chunk.astype({col: "category" for col in text_columns}))
+    result.close()
+    if not chunks:
+        return pd.DataFrame(columns=columns)
+    catalog_df = pd.DataFrame(index=range(sum(len(chunk) for chunk in chunks)))
+    for col in chunks[0].columns:
+        col_chunks = [chunk[col] for chunk in chunks]
+        # an all-NULL chunk says nothing about the column's type
+        typed_chunks = [chunk for chunk in col_chunks if chunk.notna().any()] or col_chunks
+        if all(isinstance(chunk.dtype, pd.CategoricalDtype) for chunk in typed_chunks):
+            catalog_df[col] = union_categoricals(col_chunks)
+        else:
+            catalog_df[col] = pd.concat(
+                [chunk if chunk.notna().any() else chunk.astype("float64")
+                 for chunk in col_chunks],
+                ignore_index=True,
+            )
+    return catalog_df
+
+def share_categories(src_df: pd.DataFrame, targ_df: pd.DataFrame) -> None:
+    """Give matching categorical columns of source and target one category dictionary
+
+    Merges on categoricals with identical categories run on the integer codes.
+    """
+    for col in src_df.columns.intersection(targ_df.columns):
+        if not (
+            isinstance(src_df[col].dtype, pd.CategoricalDtype)
+            and isinstance(targ_df[col].dtype, pd.CategoricalDtype)
+        ):
+            continue
+        categories = union_categoricals(
+            [src_df[col], targ_df[col]], ignore_order=True).categories
+        src_df[col] = src_df[col].cat.set_categories(categories)
+        targ_df[col] = targ_df[col].cat.set_categories(categories)
+
+def query_timeout(
+    timeout_seconds: Optional[float], deadline: Optional[float]) -> Optional[float]:
+    """Seconds a query may run given the per-query timeout and the database deadline"""
+    if deadline is None:
+        return timeout_seconds
+    remaining = deadline - perf_counter()
+    return remaining if timeout_seconds is None else min(timeout_seconds, remaining)
+
+def is_query_canceled(err: OperationalError) -> bool:
+    """Check if a query failed because the server cancelled it on statement_timeout"""
+    return getattr(err.orig, "pgcode", None) == QUERY_CANCELED
+
+def set_statement_timeout(conn: Connection, timeout_seconds: Optional[float]):
+    """Limit the statements of the current transaction to timeout_seconds"""
+    if timeout_seconds is not None:
+        conn.execute(f"SET LOCAL statement_timeout = {max(1, int(timeout_seconds * 1000))};")
+
+def execute_with_timeout(
+    conn: Connection, query, timeout_seconds: Optional[float], params: Optional[dict] = None
+) -> Optional[list]:
+    """Run a query in its own transaction, cancelled server-side after timeout_seconds
+
+    Returns None if the query timed out or there was no time left to run it.
+    """
+    if timeout_seconds is not None and timeout_seconds <= 0:
+        return None
+    try:
+        with conn.begin():
+            set_statement_timeout(conn, timeout_seconds)
+            result = conn.execute(query, params) if params else conn.execute(query)
+            return result.fetchall()
+    except OperationalError as err:
+        if not is_query_canceled(err):
+            raise
+        return None
+
+def get_table_estimate(conn: Connection, schema: str, table: str) -> Optional[int]:
+    """get the planner's estimated row count (pg_class.reltuples) of a table
+
+    Returns None for tables that were never analyzed (reltuples -1 on PG14+).
+    """
+    estimate = conn.execute(
+        q_table_estimate, {"schema": schema, "table": table}).fetchall()[0][0]
+    return estimate if estimate >= 0 else None
+
 def get_db_tables(conn: Connection) -> Tuple[pd.DataFrame, list]:
     """Get list of tables in a database"""    
     table_list_df = pd.read_sql(q_tables_list, conn)
     schemas_list = table_list_df.table_schema.unique().tolist()
     return table_list_df, schemas_list
 
-def get_source_row_counts(conn: Connection) -> pd.DataFrame:
-    """get the TABLE ROW COUNTS of source DB"""    
+def get_source_row_counts(
+    conn: Connection,
+    timeout_seconds: Optional[float] = None,
+    deadline: Optional[float] = None,
+) -> pd.DataFrame:
+    """get the TABLE ROW COUNTS of source DB
+
+    Counts that time out, or are not started before the deadline, fall back to
+    the reltuples estimate and are flagged in row_count_estimated.
+    """
     src_tables_row_count_queries_dict = {}
     src_table_rows_dict = {}
     src_table_list_df, src_schemas_list = get_db_tables(conn)
@@ -30,19 +168,32 @@ def get_source_row_counts(conn: Connection) -> pd.DataFrame:
             src_table_list_df.table_schema == schema].values.tolist()
         for table in src_tables_list:
             src_row_query = f'select count(1) from "{schema}"."{table}";'            
-            src_tables_row_count_queries_dict.update({table: src_row_query})
-    for table, row_query in src_tables_row_count_queries_dict.items():
-        src_query_result = conn.execute(row_query).fetchall()
-        src_table_rows_dict[table] = [src_query_result[0][0], row_query]
+            src_tables_row_count_queries_dict.update({table: (schema, src_row_query)})
+    for table, (schema, row_query) in src_tables_row_count_queries_dict.items():
+        src_query_result = execute_with_timeout(
+            conn, row_query, query_timeout(timeout_seconds, deadline))
+        if src_query_result is None:
+            src_table_rows_dict[table] = [
+                get_table_estimate(conn, schema, table), row_query, True]
+        else:
+            src_table_rows_dict[table] = [src_query_result[0][0], row_query, False]
     src_table_row_counts_df = pd.DataFrame.from_dict(
         data=src_table_rows_dict,
         orient="index",
-        columns=["row_count", "query_executed"],
+        columns=["row_count", "query_executed", "row_count_estimated"],
     )
     return src_table_row_counts_df
 
-def get_target_row_counts(conn: Connection) -> pd.DataFrame:
-    """get the TABLE ROW COUNTS of target DB"""    
+def get_target_row_counts(
+    conn: Connection,
+    timeout_seconds: Optional[float] = None,
+    deadline: Optional[float] = None,
+) -> pd.DataFrame:
+    """get the TABLE ROW COUNTS of target DB
+
+    Counts that time out, or are not started before the deadline, fall back to
+    the reltuples estimate and are flagged in row_count_estimated.
+    """
     targ_tables_row_count_queries_dict = {}
     targ_table_rows_dict = {}
     targ_table_list_df, targ_schemas_list = get_db_tables(conn)
@@ -51,14 +202,19 @@ def get_target_row_counts(conn: Connection) -> pd.DataFrame:
             targ_table_list_df.table_schema == schema].values.tolist()
         for table in targ_tables_list:
             targ_row_query = f'select count(1) from "{schema}"."{table}";'            
-            targ_tables_row_count_queries_dict.update({table: targ_row_query})
-    for table, row_query in targ_tables_row_count_queries_dict.items():
-        targ_query_result = conn.execute(row_query).fetchall()
-        targ_table_rows_dict[table] = [targ_query_result[0][0], row_query]
+            targ_tables_row_count_queries_dict.update({table: (schema, targ_row_query)})
+    for table, (schema, row_query) in targ_tables_row_count_queries_dict.items():
+        targ_query_result = execute_with_timeout(
+            conn, row_query, query_timeout(timeout_seconds, deadline))
+        if targ_query_result is None:
+            targ_table_rows_dict[table] = [
+                get_table_estimate(conn, schema, table), row_query, True]
+        else:
+            targ_table_rows_dict[table] = [targ_query_result[0][0], row_query, False]
     targ_table_row_counts_df = pd.DataFrame.from_dict(
         data=targ_table_rows_dict,
         orient="index",
-        columns=["row_count", "query_executed"],
+        columns=["row_count", "query_executed", "row_count_estimated"],
     )
     return targ_table_row_counts_df
 
@@ -72,10 +228,80 @@ def get_views(
 def get_columns(
     source_conn: Connection, target_conn: Connection) -> Tuple[pd.DataFrame, pd.DataFrame]:
     """get the COLUMNS of source and target DB"""    
-    src_columns_df = pd.read_sql(q_columns, source_conn)
-    targ_columns_df = pd.read_sql(q_columns, target_conn)
+    src_columns_df = read_sql_categorical(q_columns, source_conn)
+    targ_columns_df = read_sql_categorical(q_columns, target_conn)
+    share_categories(src_columns_df, targ_columns_df)
     return src_columns_df, targ_columns_df
 
+def get_column_types(
+    source_conn: Connection, target_conn: Connection) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    """get the COLUMNS and their DATA TYPES of the tables of source and target DB"""
+    src_column_types_df = read_sql_categorical(q_column_types, source_conn)
+    targ_column_types_df = read_sql_categorical(q_column_types, target_conn)
+    share_categories(src_column_types_df, targ_column_types_df)
+    return src_column_types_df, targ_column_types_df
+
+def get_column_fingerprints(
+    conn: Connection,
+    schema: str,
+    table: str,
+    columns_df: pd.DataFrame,
+    timeout_seconds: Optional[float] = None,
+    deadline: Optional[float] = None,
+) -> Tuple[Optional[pd.DataFrame], List[str]]:
+    """get the per-column aggregate FINGERPRINTS of a table in a single scan
+
+    Every column gets a null count and an order-independent hash sum, ordered
+    types a min and max, exact numeric types a sum and text types a sum of lengths.
+    Returns None for the fingerprints if a scan timed out or the deadline passed.
+    """
+    fingerprints = []
+    queries = []
+    for start in range(0, len(columns_df), FINGERPRINT_MAX_COLUMNS):
+        chunk = columns_df.iloc[start:start + FINGERPRINT_MAX_COLUMNS]
+        aggregates = []
+        for i, (column, data_type) in enumerate(zip(chunk.column_name, chunk.data_type)):
+            col = f't."{column}"'
+            aggregates.append(f"count(*) - count({col}) as c{i}_null_count")
+            if data_type in TEXT_TYPES:
+                # byte order, so source and target agree whatever their collations
+                aggregates.append(f'min({col} COLLATE "C")::text as c{i}_min_value')
+                aggregates.append(f'max({col} COLLATE "C")::text as c{i}_max_value')
+            elif data_type in ORDERED_TYPES:
+                aggregates.append(f"min({col})::text as c{i}_min_value")
+                aggregates.append(f"max({col})::text as c{i}_max_value")
+            else:
+                aggregates.append(f"null as c{i}_min_value")
+                aggregates.append(f"null as c{i}_max_value")
+            if data_type in EXACT_NUMERIC_TYPES:
+                aggregates.append(f"sum({col}::numeric)::text as c{i}_value_sum")
+            else:
+                aggregates.append(f"null as c{i}_value_sum")
+            if data_type in TEXT_TYPES:
+                aggregates.append(f"sum(length({col}))::text as c{i}_length_sum")
+            else:
+                aggregates.append(f"null as c{i}_length_sum")
+            aggregates.append(
+                f"coalesce(sum(('x' || substr(md5({col}::text), 1, 8))::bit(32)::int), 0)::text"
+                f" as c{i}_hash_sum")
+        fingerprint_query = (
+            f'select {", ".join(aggregates)} from "{schema}"."{table}" as t;')
+        queries.append(fingerprint_query)
+        results = execute_with_timeout(
+            conn, fingerprint_query, query_timeout(timeout_seconds, deadline))
+        if results is None:
+            return None, queries
+        result = results[0]
+        for i, column in enumerate(chunk.column_name):
+            fingerprints.append(
+                [schema, table, column]
+                + [result[f"c{i}_{metric}"] for metric in FINGERPRINT_METRICS])
+    fingerprints_df = pd.DataFrame(
+        data=fingerprints,
+        columns=["table_schema", "table_name", "column_name"] + FINGERPRINT_METRICS,
+    )
+    return fingerprints_df, queries
+
 def get_triggers(
     source_conn: Connection, target_conn: Connection) -> Tuple[pd.DataFrame, pd.DataFrame]:
     """get the TRIGGERS of source and target DB"""    
@@ -86,8 +312,9 @@ def get_triggers(
 def get_usage_privileges(
     source_conn: Connection, target_conn: Connection) -> Tuple[pd.DataFrame, pd.DataFrame]:
     """get the USAGE PRIVILEGES of source and target DB"""    
-    src_usage_privileges_df = pd.read_sql(q_usage_privileges, source_conn)
-    targ_usage_privileges_df = pd.read_sql(q_usage_privileges, target_conn)
+    src_usage_privileges_df = read_sql_categorical(q_usage_privileges, source_conn)
+    targ_usage_privileges_df = read_sql_categorical(q_usage_privileges, target_conn)
+    share_categories(src_usage_privileges_df, targ_usage_privileges_df)
     return src_usage_privileges_df, targ_usage_privileges_df
 
 def get_sequences(
@@ -123,4 +350,142 @@ def get_extensions(
     """get the EXTENSIONS of source and target DB"""    
     src_extensions_df = pd.read_sql(q_extensions, source_conn)
     targ_extensions_df = pd.read_sql(q_extensions, target_conn)
-    return src_extensions_df, targ_extensions_df
\ No newline at end of file
+    return src_extensions_df, targ_extensions_df
+
+def get_definition_digests(
+    source_conn: Connection, target_conn: Connection) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    """get the normalized DEFINITION DIGESTS of the views and routines of source and target DB"""
+    params = {
+        "token_pattern": DEFINITION_TOKEN_PATTERN,
+        "normalized_languages": NORMALIZED_LANGUAGES,
+    }
+    src_digests_df = pd.read_sql(q_definition_digests, source_conn, params=params)
+    targ_digests_df = pd.read_sql(q_definition_digests, target_conn, params=params)
+    return src_digests_df, targ_digests_df
+
+def get_definitions(conn: Connection, objects_df: pd.DataFrame) -> pd.DataFrame:
+    """get the full DEFINITIONS (and languages) of the given views and routines"""
+    return pd.read_sql(
+        q_definitions,
+        conn,
+        params={
+            "object_types": objects_df.object_type.tolist(),
+            "object_schemas": objects_df.object_schema.tolist(),
+            "object_names": objects_df.object_name.tolist(),
+            "identity_arguments": objects_df.identity_arguments.tolist(),
+        },
+    )
+
+def get_primary_keys(conn: Connection) -> pd.DataFrame:
+    """get the PRIMARY KEY columns (with type and estimated size) of each table
+
+    Tables without a primary key are returned as a single row with a null
+    column_name.
+    """
+    return pd.read_sql(q_primary_keys, conn)
+
+def get_sample_plan(reltuples: float, relpages: int, sample_rows: int) -> Tuple[str, float]:
+    """Choose the TABLESAMPLE method and percent that yield about sample_rows rows
+
+    Tables that were never analyzed (reltuples <= 0) are sized from their
+    on-disk pages instead.
+    """
+    estimated_rows = reltuples if reltuples > 0 else max(relpages, 1) * UNANALYZED_ROWS_PER_PAGE
+    method = "SYSTEM" if estimated_rows > SYSTEM_SAMPLE_MIN_ROWS else "BERNOULLI"
+    # oversample slightly so the sample still reaches sample_rows after trimming
+    percent = min(100.0, 150.0 * sample_rows / estimated_rows)
+    return method, percent
+
+def get_sampled_row_hashes(
+    conn: Connection,
+    schema: str,
+    table: str,
+    key_columns: List[str],
+    method: str,
+    percent: float,
+    sample_rows: int,
+    sample_seconds: float,
+    seed: int,
+) -> Tuple[pd.DataFrame, str, bool]:
+    """get the keys and row hashes of a deterministic TABLESAMPLE of a table
+
+    method and percent come from get_sample_plan. The sampled rows are ordered
+    on a seeded hash of their key before the LIMIT, so trimming the oversample
+    keeps a uniform subset rather than the front of the heap. Fetching stops once sample_rows rows are read or sample_seconds have
+    elapsed, whichever comes first; rows read before a timeout are kept and
+    the sample is flagged as incomplete. The heap block of each row is
+    returned too, since SYSTEM samples whole blocks rather than single rows.
+    """
+    key_select = ", ".join(
+        f't."{col}"::text as k{i}' for i, col in enumerate(key_columns))
+    key_row = ", ".join(f't."{col}"' for col in key_columns)
+    sample_query = (
+        f"select {key_select}, md5(t::text) as row_hash, "
+        f"(t.ctid::text::point)[0]::bigint as block "
+        f'from "{schema}"."{table}" as t '
+        f"TABLESAMPLE {method} ({percent:.6f}) REPEATABLE ({seed}) "
+        f"order by md5('{seed}' || row({key_row})::text) limit {sample_rows};")
+    deadline = perf_counter() + sample_seconds
+    rows = []
+    complete = False
+    try:
+        with conn.begin():
+            # the server cancels a fetch that would overrun the sample budget
+            set_statement_timeout(conn, sample_seconds)
+            result = conn.execution_options(stream_results=True).execute(sample_query)
+            while perf_counter() < deadline:
+                batch = result.fetchmany(SAMPLE_FETCH_SIZE)
+                if not batch:
+                    complete = True
+                    break
+                rows.extend(batch)
+            result.close()
+    except OperationalError as err:
+        if not is_query_canceled(err):
+            raise
+    columns = [f"k{i}" for i in range(len(key_columns))] + ["row_hash", "block"]
+    return pd.DataFrame(rows, columns=columns), sample_query, complete
+
+def get_row_hashes_by_keys(
+    conn: Connection,
+    schema: str,
+    table: str,
+    key_columns: List[str],
+    key_types: List[str],
+    keys_df: pd.DataFrame,
+    batch_size: int = SAMPLE_LOOKUP_BATCH_SIZE,
+    timeout_seconds: Optional[float] = None,
+    deadline: Optional[float] = None,
+) -> Tuple[pd.DataFrame, int]:
+    """get the row hashes of a table for the given keys, looked up in batches
+
+    Also returns how many of the keys were looked up before a batch timed out
+    or the deadline passed.
+    """
+    key_names = [f"k{i}" for i in range(len(key_columns))]
+    key_select = ", ".join(
+        f't."{col}"::text as {name}' for col, name in zip(key_columns, key_names))
+    key_arrays = [
+        f"CAST(CAST(:{name} AS text[]) AS {data_type}[])"
+        for name, data_type in zip(key_names, key_types)
+    ]
+    if len(key_columns) == 1:
+        key_filter = f't."{key_columns[0]}" = ANY({key_arrays[0]})'
+    else:
+        key_tuple = ", ".join(f't."{col}"' for col in key_columns)
+        key_filter = f"({key_tuple}) IN (select * from unnest({', '.join(key_arrays)}))"
+    lookup_query = text(
+        f'select {key_select}, md5(t::text) as row_hash from "{schema}"."{table}" as t '
+        f"where {key_filter};")
+    rows = []
+    looked_up = 0
+    for start in range(0, len(keys_df), batch_size):
+        batch = keys_df.iloc[start:start + batch_size]
+        params = {name: batch[name].tolist() for name in key_names}
+        batch_rows = execute_with_timeout(
+            conn, lookup_query, query_timeout(timeout_seconds, deadline), params)
+        if batch_rows is None:
+            break
+        rows.extend(batch_rows)
+        looked_up += len(batch)
+    return pd.DataFrame(rows, columns=key_names + ["row_hash"]), looked_up
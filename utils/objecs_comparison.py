@@ -1,12 +1,18 @@
+import re
 from datetime import date
-from typing import Tuple
+from difflib import unified_diff
+from math import sqrt
+from typing import List, Optional, Tuple
 import pandas as pd
 from sqlalchemy.engine.base import Connection
+from sqlalchemy.exc import DBAPIError
 from utils.db_objects import (
     get_source_row_counts,
     get_target_row_counts,
     get_views,
     get_columns,
+    get_column_types,
+    get_column_fingerprints,
     get_triggers,
     get_usage_privileges,
     get_sequences,
@@ -14,10 +20,21 @@ from utils.db_objects import (
     get_procedures,
     get_foreign_data_wrappers,
     get_extensions,
+    get_definition_digests,
+    get_definitions,
+    get_primary_keys,
+    get_sample_plan,
+    get_sampled_row_hashes,
+    get_row_hashes_by_keys,
+    query_timeout,
+    FINGERPRINT_METRICS,
 )
 from utils.schemas import (
+    DEFINITION_TOKEN_PATTERN,
+    NORMALIZED_LANGUAGES,
     q_sequences,
     q_columns,
+    q_definition_digests,
     q_functions,
     q_extensions,
     q_fdw,
@@ -28,19 +45,90 @@ from utils.schemas import (
     q_views,
 )
 merge_lookup = {"both": "both", "left_only": "source_only", "right_only": "target_only"}
+CONFIDENCE_Z = 1.96  # two-sided 95% confidence
+EXCEL_CELL_MAX_CHARS = 32767
+QUOTED_TOKEN = re.compile(DEFINITION_TOKEN_PATTERN, re.S)
+DEFINITION_KEYS = ["object_type", "object_schema", "object_name", "identity_arguments"]
+
+def mismatch_rate_upper_bound(mismatches: int, sampled: int, z: float = CONFIDENCE_Z) -> float:
+    """Upper Wilson score bound of the mismatch rate observed in a sample"""
+    if sampled == 0:
+        return 1.0
+    rate = mismatches / sampled
+    denominator = 1 + z**2 / sampled
+    centre = rate + z**2 / (2 * sampled)
+    margin = z * sqrt(rate * (1 - rate) / sampled + z**2 / (4 * sampled**2))
+    return min(1.0, (centre + margin) / denominator)
+
+def normalize_definition(definition: str, schema: str, language: str = "sql") -> List[str]:
+    """Normalize a view or routine definition line by line, as q_definition_digests does
+
+    Lowercases and collapses whitespace outside 'literals' and "quoted
+    identifiers", drops the object's own schema and pg_catalog qualifiers
+    outside 'literals' and skips blank lines. Bodies in other languages than
+    NORMALIZED_LANGUAGES are returned verbatim.
+    """
+    if language not in NORMALIZED_LANGUAGES:
+        return definition.splitlines()
+    qualifiers = ['"' + re.escape(schema) + '"']
+    # unquoted names fold to lowercase, so they only name a lowercase schema
+    if schema == schema.lower():
+        qualifiers.append(re.escape(schema))
+    qualifiers.append("pg_catalog")
+    qualifier = re.compile(r'(^|[^\w"])(' + "|".join(qualifiers) + r")\.", re.M)
+    # runs of tokens between 'literals', each literal on its own
+    segments = []
+    for match in QUOTED_TOKEN.finditer(definition):
+        token = match.group(0)
+        is_literal = token[0] == "'"
+        if token[0] not in "'\"":
+            token = re.sub(r"[^\S\n]+", " ", token.lower())
+        if is_literal or not segments or segments[-1][0]:
+            segments.append([is_literal, token])
+        else:
+            segments[-1][1] += token
+    folded = "".join(
+        segment if is_literal else qualifier.sub(r"\1", segment)
+        for is_literal, segment in segments)
+    normalized_lines = []
+    for line in folded.splitlines():
+        line = line.strip()
+        if line:
+            normalized_lines.append(line)
+    return normalized_lines
+
 def compare_row_counts(
-    source_conn: Connection, target_conn: Connection) -> Tuple[pd.DataFrame, bool]:
-    """Compare the TABLE ROW COUNTS of source vs target DB"""    
+    source_conn: Connection,
+    target_conn: Connection,
+    timeout_seconds: Optional[float] = None,
+    deadline: Optional[float] = None,
+) -> Tuple[pd.DataFrame, bool]:
+    """Compare the TABLE ROW COUNTS of source vs target DB
+
+    Counts are only reported equal when none of them fell back to an estimate.
+    """
     table_rows_check = False    
-    src_table_row_counts_df = get_source_row_counts(source_conn)
-    targ_table_row_counts_df = get_target_row_counts(target_conn)
+    src_table_row_counts_df = get_source_row_counts(source_conn, timeout_seconds, deadline)
+    targ_table_row_counts_df = get_target_row_counts(target_conn, timeout_seconds, deadline)
     if src_table_row_counts_df["row_count"].equals(
         targ_table_row_counts_df["row_count"]
+    ) and not (
+        src_table_row_counts_df.row_count_estimated.any()
+        or targ_table_row_counts_df.row_count_estimated.any()
     ):
         table_rows_check = True    
-        rows_compared = src_table_row_counts_df.copy().join(
-        targ_table_row_counts_df.row_count, how="outer", rsuffix="_target"    )
-    rows_compared.rename(columns={"row_count": "row_count_source"}, inplace=True)
+    rows_compared = src_table_row_counts_df.join(
+        targ_table_row_counts_df[["row_count", "row_count_estimated"]],
+        how="outer",
+        rsuffix="_target",
+    )
+    rows_compared.rename(
+        columns={
+            "row_count": "row_count_source",
+            "row_count_estimated": "row_count_estimated_source",
+        },
+        inplace=True,
+    )
     rows_compared["difference_count"] = (
         rows_compared.row_count_source - rows_compared.row_count_target    )
     rows_compared.insert(
@@ -116,10 +204,10 @@ def compare_columns(source_conn: Connection, target_conn: Connection):
     columns_check = False    
     src_columns_df, targ_columns_df = get_columns(source_conn, target_conn)
     columns_merged = src_columns_df.merge(targ_columns_df, how="outer", indicator=True)
-    columns_merged.rename(columns={"_merge": "source_v_target"}, inplace=True)
-    columns_merged["source_v_target"] = columns_merged["source_v_target"].map(
-        merge_lookup    )
-    columns_compared = columns_merged[~columns_merged["source_v_target"].isin(["both"])]
+    columns_compared = columns_merged[columns_merged["_merge"] != "both"].rename(
+        columns={"_merge": "source_v_target"})
+    columns_compared["source_v_target"] = columns_compared[
+        "source_v_target"].cat.rename_categories(merge_lookup)
     columns_compared.columns = [
         ["Columns_Comparision"] * len(columns_compared.columns.to_list()),
         columns_compared.columns.to_list(),
@@ -201,12 +289,11 @@ def compare_usage_privileges(source_conn: Connection, target_conn: Connection):
         source_conn, target_conn    )
     usage_privileges_merged = src_usage_privileges_df.merge(
         targ_usage_privileges_df, how="outer", indicator=True    )
-    usage_privileges_merged.rename(columns={"_merge": "source_v_target"}, inplace=True)
-    usage_privileges_merged["source_v_target"] = usage_privileges_merged[
-        "source_v_target"    ].map(merge_lookup)
     usage_privileges_compared = usage_privileges_merged[
-        ~usage_privileges_merged["source_v_target"].isin(["both"])
-    ]
+        usage_privileges_merged["_merge"] != "both"
+    ].rename(columns={"_merge": "source_v_target"})
+    usage_privileges_compared["source_v_target"] = usage_privileges_compared[
+        "source_v_target"].cat.rename_categories(merge_lookup)
     usage_privileges_compared.columns = [
         ["Usage_privileges_Comparision"]
         * len(usage_privileges_compared.columns.to_list()),
@@ -448,4 +535,345 @@ def compare_extensions(source_conn: Connection, target_conn: Connection):
         column=("Extensions_Comparision", "validation_date"),
         value=date.today(),
     )
-    return extensions_compared, extensions_check
\ No newline at end of file
+    return extensions_compared, extensions_check
+
+
+def compare_sampled_rows(
+    source_conn: Connection,
+    target_conn: Connection,
+    sample_rows: int = 10000,
+    sample_seconds: float = 30.0,
+    seed: int = 42,
+    timeout_seconds: Optional[float] = None,
+    deadline: Optional[float] = None,
+):
+    """Compare a TABLESAMPLE of the TABLE ROWS of source vs target DB
+
+    Keys and row hashes are sampled on the source and looked up by key on the
+    target. Tables without a primary key cannot be matched and are skipped, as
+    are tables reached after the deadline; both fail the check. SYSTEM samples
+    whole blocks, so their upper bound is computed over blocks, not rows.
+    """
+    sampled_rows_check = True
+    sample_results = []
+    src_keys_df = get_primary_keys(source_conn)
+    targ_keys_df = get_primary_keys(target_conn)
+    for (schema, table), src_table_keys in src_keys_df.groupby(
+        ["table_schema", "table_name"], sort=False
+    ):
+        if src_table_keys.column_name.isna().all():
+            sampled_rows_check = False
+            sample_results.append(
+                [schema, table, None, 0, 0, 0, None, None, "skipped - no primary key", None])
+            continue
+        key_columns = src_table_keys.column_name.tolist()
+        targ_table_keys = targ_keys_df.loc[
+            (targ_keys_df.table_schema == schema) & (targ_keys_df.table_name == table)
+        ]
+        if targ_table_keys.column_name.tolist() != key_columns:
+            sampled_rows_check = False
+            sample_results.append(
+                [schema, table, None, 0, 0, 0, None, None, "primary key differs on target", None])
+            continue
+        table_sample_seconds = query_timeout(sample_seconds, deadline)
+        if table_sample_seconds <= 0:
+            sampled_rows_check = False
+            sample_results.append(
+                [schema, table, None, 0, 0, 0, None, None, "skipped - time budget exhausted", None])
+            continue
+        sample_method, sample_percent = get_sample_plan(
+            float(src_table_keys.reltuples.iloc[0]),
+            int(src_table_keys.relpages.iloc[0]),
+            sample_rows,
+        )
+        src_sample_df, sample_query, sample_complete = get_sampled_row_hashes(
+            source_conn,
+            schema,
+            table,
+            key_columns,
+            sample_method,
+            sample_percent,
+            sample_rows,
+            table_sample_seconds,
+            seed,
+        )
+        targ_sample_df, looked_up = get_row_hashes_by_keys(
+            target_conn,
+            schema,
+            table,
+            key_columns,
+            targ_table_keys.data_type.tolist(),
+            src_sample_df,
+            timeout_seconds=timeout_seconds,
+            deadline=deadline,
+        )
+        # keys whose lookup timed out are unverified, not missing
+        sample_complete = sample_complete and looked_up == len(src_sample_df)
+        src_sample_df = src_sample_df.iloc[:looked_up]
+        samples_merged = src_sample_df.merge(
+            targ_sample_df,
+            how="left",
+            on=[col for col in src_sample_df.columns if col not in ("row_hash", "block")],
+            suffixes=("_source", "_target"),
+        )
+        sampled = len(samples_merged)
+        missing = int(samples_merged.row_hash_target.isna().sum())
+        mismatched_mask = samples_merged.row_hash_source != samples_merged.row_hash_target
+        mismatched = int(mismatched_mask.sum())
+        if sample_method == "SYSTEM":
+            sample_unit = "blocks"
+            upper_bound = mismatch_rate_upper_bound(
+                samples_merged.loc[mismatched_mask, "block"].nunique(),
+                samples_merged.block.nunique(),
+            )
+        else:
+            sample_unit = "rows"
+            upper_bound = mismatch_rate_upper_bound(mismatched, sampled)
+        if mismatched or not sample_complete:
+            sampled_rows_check = False
+        sample_results.append(
+            [
+                schema,
+                table,
+                sample_unit,
+                sampled,
+                mismatched,
+                missing,
+                mismatched / sampled if sampled else None,
+                upper_bound,
+                "complete" if sample_complete else "partial - timed out",
+                sample_query,
+            ]
+        )
+    sampled_rows_compared = pd.DataFrame(
+        data=sample_results,
+        columns=[
+            "table_schema",
+            "table_name",
+            "sample_unit",
+            "sampled_rows",
+            "mismatched_rows",
+            "missing_on_target",
+            "mismatch_rate",
+            "mismatch_rate_upper_95",
+            "status",
+            "query_executed",
+        ],
+    )
+    sampled_rows_compared.columns = [
+        ["Sampled_Rows_Comparison"] * len(sampled_rows_compared.columns.to_list()),
+        sampled_rows_compared.columns.to_list(),
+    ]
+    if sampled_rows_compared.empty:
+        sampled_rows_compared = pd.DataFrame(
+            data=["N/A - No tables with a primary key"],
+            columns=[["Sampled_Rows_Comparison"], ["Source_v_Target"]],
+        )
+    sampled_rows_compared.insert(
+        loc=len(sampled_rows_compared.columns) - 1,
+        column=("Sampled_Rows_Comparison", "migration_date"),
+        value=date.today(),
+    )
+    sampled_rows_compared.insert(
+        loc=len(sampled_rows_compared.columns) - 1,
+        column=("Sampled_Rows_Comparison", "validation_date"),
+        value=date.today(),
+    )
+    return sampled_rows_compared, sampled_rows_check
+
+
+def compare_column_fingerprints(
+    source_conn: Connection,
+    target_conn: Connection,
+    timeout_seconds: Optional[float] = None,
+    deadline: Optional[float] = None,
+):
+    """Compare the per-column aggregate FINGERPRINTS of source vs target DB
+
+    Only columns present in both DBs are fingerprinted; missing columns are
+    reported by compare_columns. Tables whose scan timed out or failed are
+    reported as not fingerprinted, tables reached after the deadline as skipped.
+    """
+    column_fingerprints_check = True
+    fingerprint_results = []
+    src_column_types_df, targ_column_types_df = get_column_types(source_conn, target_conn)
+    common_columns_df = src_column_types_df.merge(
+        targ_column_types_df,
+        how="inner",
+        on=["table_schema", "table_name", "column_name"],
+        suffixes=("_source", "_target"),
+    )
+    for (schema, table), table_columns_df in common_columns_df.groupby(
+        ["table_schema", "table_name"], sort=False, observed=True
+    ):
+        table_timeout = query_timeout(timeout_seconds, deadline)
+        if table_timeout is not None and table_timeout <= 0:
+            column_fingerprints_check = False
+            fingerprint_results.append(
+                [schema, table, None, "skipped - time budget exhausted", None, None, None])
+            continue
+        src_queries = []
+        targ_fingerprints_df = None
+        fingerprint_status = "not fingerprinted - timed out"
+        try:
+            src_fingerprints_df, src_queries = get_column_fingerprints(
+                source_conn,
+                schema,
+                table,
+                table_columns_df.rename(columns={"data_type_source": "data_type"}),
+                timeout_seconds,
+                deadline,
+            )
+            if src_fingerprints_df is not None:
+                targ_fingerprints_df, _ = get_column_fingerprints(
+                    target_conn,
+                    schema,
+                    table,
+                    table_columns_df.rename(columns={"data_type_target": "data_type"}),
+                    timeout_seconds,
+                    deadline,
+                )
+        except DBAPIError:
+            # one table's failing scan must not discard the rest of the database
+            fingerprint_status = "not fingerprinted - query error"
+        # the scan queries are long, report them once per table and within a cell
+        table_query = "\n".join(src_queries)[:EXCEL_CELL_MAX_CHARS]
+        if targ_fingerprints_df is None:
+            column_fingerprints_check = False
+            fingerprint_results.append(
+                [schema, table, None, fingerprint_status, None, None, table_query])
+            continue
+        fingerprints_merged = src_fingerprints_df.merge(
+            targ_fingerprints_df,
+            on=["table_schema", "table_name", "column_name"],
+            suffixes=("_source", "_target"),
+        )
+        for _, row in fingerprints_merged.iterrows():
+            for metric in FINGERPRINT_METRICS:
+                src_value, targ_value = row[f"{metric}_source"], row[f"{metric}_target"]
+                if src_value == targ_value or (pd.isna(src_value) and pd.isna(targ_value)):
+                    continue
+                column_fingerprints_check = False
+                fingerprint_results.append(
+                    [schema, table, row.column_name, metric, src_value, targ_value,
+                     table_query])
+                table_query = ""
+    column_fingerprints_compared = pd.DataFrame(
+        data=fingerprint_results,
+        columns=[
+            "table_schema",
+            "table_name",
+            "column_name",
+            "metric",
+            "value_source",
+            "value_target",
+            "query_executed",
+        ],
+    )
+    column_fingerprints_compared.columns = [
+        ["Column_Fingerprints_Comparison"]
+        * len(column_fingerprints_compared.columns.to_list()),
+        column_fingerprints_compared.columns.to_list(),
+    ]
+    if column_fingerprints_compared.empty:
+        column_fingerprints_compared = pd.DataFrame(
+            data=["source & target are the same"],
+            columns=[["Column_Fingerprints_Comparison"], ["Source_v_Target"]],
+        )
+    column_fingerprints_compared.insert(
+        loc=len(column_fingerprints_compared.columns) - 1,
+        column=("Column_Fingerprints_Comparison", "migration_date"),
+        value=date.today(),
+    )
+    column_fingerprints_compared.insert(
+        loc=len(column_fingerprints_compared.columns) - 1,
+        column=("Column_Fingerprints_Comparison", "validation_date"),
+        value=date.today(),
+    )
+    return column_fingerprints_compared, column_fingerprints_check
+
+
+def compare_definitions(source_conn: Connection, target_conn: Connection):
+    """Compare the normalized VIEW and ROUTINE DEFINITIONS of source vs target DB
+
+    Definitions are compared by digest; full texts and a line diff are only
+    fetched for objects whose digests differ.
+    """
+    definitions_check = False
+    src_digests_df, targ_digests_df = get_definition_digests(source_conn, target_conn)
+    definitions_merged = src_digests_df.merge(
+        targ_digests_df,
+        how="outer",
+        on=DEFINITION_KEYS,
+        suffixes=("_source", "_target"),
+        indicator=True,
+    )
+    definitions_merged.rename(columns={"_merge": "source_v_target"}, inplace=True)
+    definitions_merged["source_v_target"] = definitions_merged[
+        "source_v_target"].astype(str).map(merge_lookup)
+    definitions_merged.loc[
+        (definitions_merged.source_v_target == "both")
+        & (definitions_merged.definition_digest_source
+           != definitions_merged.definition_digest_target),
+        "source_v_target",
+    ] = "definition_differs"
+    definitions_compared = definitions_merged.loc[
+        ~definitions_merged["source_v_target"].isin(["both"]),
+        DEFINITION_KEYS + ["source_v_target"],
+    ]
+    changed_df = definitions_compared.loc[
+        definitions_compared.source_v_target == "definition_differs", DEFINITION_KEYS]
+    definition_diffs = []
+    if not changed_df.empty:
+        src_definitions_df = get_definitions(source_conn, changed_df)
+        targ_definitions_df = get_definitions(target_conn, changed_df)
+        definitions_changed = src_definitions_df.merge(
+            targ_definitions_df, on=DEFINITION_KEYS, suffixes=("_source", "_target"))
+        for _, row in definitions_changed.iterrows():
+            definition_diff = "\n".join(
+                unified_diff(
+                    normalize_definition(
+                        row.definition_source, row.object_schema, row.language_source),
+                    normalize_definition(
+                        row.definition_target, row.object_schema, row.language_target),
+                    fromfile="source",
+                    tofile="target",
+                    lineterm="",
+                )
+            )
+            definition_diffs.append(
+                row[DEFINITION_KEYS].tolist() + [definition_diff[:EXCEL_CELL_MAX_CHARS]])
+    definitions_compared = definitions_compared.merge(
+        pd.DataFrame(data=definition_diffs, columns=DEFINITION_KEYS + ["definition_diff"]),
+        how="left",
+        on=DEFINITION_KEYS,
+    )
+    definitions_compared.columns = [
+        ["Definitions_Comparision"] * len(definitions_compared.columns.to_list()),
+        definitions_compared.columns.to_list(),
+    ]
+    if definitions_compared.empty:
+        definitions_check = True
+        definitions_compared = pd.DataFrame(
+            data=["source & target are the same"],
+            columns=[
+                ["Definitions_Comparision"],
+                ["Source_v_Target"],
+            ],
+        )
+    definitions_compared.insert(
+        loc=len(definitions_compared.columns) - 1,
+        column=("Definitions_Comparision", "query_executed"),
+        value=q_definition_digests,
+    )
+    definitions_compared.insert(
+        loc=len(definitions_compared.columns) - 1,
+        column=("Definitions_Comparision", "migration_date"),
+        value=date.today(),
+    )
+    definitions_compared.insert(
+        loc=len(definitions_compared.columns) - 1,
+        column=("Definitions_Comparision", "validation_date"),
+        value=date.today(),
+    )
+    return definitions_compared, definitions_check
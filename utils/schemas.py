@@ -16,7 +16,7 @@ q_tables_list = text(
        order by table_schema, table_name;""")
 
 q_views = text(
-    """select table_catalog, table_schema, table_name, view_definition from information_schema.views         
+    """select table_catalog, table_schema, table_name from information_schema.views         
     where table_schema not like 'pg_%' and table_schema not like 'information%'         
     AND table_name not like 'pg_%'        
     order by table_name ;""")
@@ -63,3 +63,100 @@ q_fdw = text("SELECT fdwname FROM pg_foreign_data_wrapper order by fdwname;")
 
 q_extensions = text(
     "SELECT extname FROM pg_extension where extname not like 'pg_%' order by extname;")
+
+q_primary_keys = text(
+    """SELECT n.nspname AS table_schema, c.relname AS table_name, a.attname AS column_name,
+       format_type(a.atttypid, a.atttypmod) AS data_type, c.reltuples AS reltuples,
+       pg_relation_size(c.oid) / current_setting('block_size')::int AS relpages
+       FROM pg_class c
+       JOIN pg_namespace n ON n.oid = c.relnamespace
+       LEFT JOIN pg_index i ON i.indrelid = c.oid AND i.indisprimary
+       LEFT JOIN LATERAL unnest(i.indkey) WITH ORDINALITY AS k(attnum, ord) ON true
+       LEFT JOIN pg_attribute a ON a.attrelid = c.oid AND a.attnum = k.attnum
+       WHERE c.relkind = 'r'
+       AND n.nspname not like 'pg_%' AND n.nspname not like 'information%'
+       AND c.relname not like 'pg_%'
+       ORDER BY n.nspname, c.relname, k.ord;""")
+
+q_column_types = text(
+    """select c.table_schema, c.table_name, c.column_name, c.data_type from information_schema.columns c
+       join information_schema.tables t
+       on t.table_schema = c.table_schema and t.table_name = c.table_name and t.table_type = 'BASE TABLE'
+       where c.table_schema not like 'pg_%' and c.table_schema not like 'information%'
+       and c.table_name not like 'pg_%'
+       ORDER BY c.table_schema, c.table_name, c.ordinal_position ;""")
+
+q_table_estimate = text(
+    """SELECT c.reltuples::bigint FROM pg_class c
+       JOIN pg_namespace n ON n.oid = c.relnamespace
+       WHERE n.nspname = :schema AND c.relname = :table;""")
+
+
+# view and routine definitions, compared by digest in q_definition_digests and
+# only pulled in full (q_definitions) for objects whose digests differ
+definitions_cte = r"""with definitions as (
+    select n.nspname as object_schema, c.relname as object_name, '' as identity_arguments,
+    case c.relkind when 'v' then 'VIEW' else 'MATERIALIZED VIEW' end as object_type,
+    'sql' as language, pg_get_viewdef(c.oid) as definition
+    from pg_class c join pg_namespace n on n.oid = c.relnamespace
+    where c.relkind in ('v', 'm')
+    and n.nspname not like 'pg_%' and n.nspname not like 'information%'
+    and c.relname not like 'pg_%'
+    union all
+    select n.nspname, p.proname, pg_get_function_identity_arguments(p.oid),
+    case p.prokind when 'p' then 'PROCEDURE' else 'FUNCTION' end,
+    l.lanname, pg_get_functiondef(p.oid)
+    from pg_proc p join pg_namespace n on n.oid = p.pronamespace
+    join pg_language l on l.oid = p.prolang
+    where p.prokind in ('f', 'p')
+    and n.nspname not like 'pg_%' and n.nspname not like 'information%'
+    and p.proname not like 'pg_%'
+    and not exists (
+        select 1 from pg_depend d
+        where d.classid = 'pg_proc'::regclass and d.objid = p.oid and d.deptype = 'e'))
+"""
+
+# tokens of a definition: 'literals', "quoted identifiers", other text and stray quotes;
+# the digest query and utils.objecs_comparison.normalize_definition both split on it
+DEFINITION_TOKEN_PATTERN = r"""'(?:[^']|'')*'|"(?:[^"]|"")*"|[^'"]+|."""
+# routine languages whose bodies are SQL text, other bodies are compared verbatim
+NORMALIZED_LANGUAGES = ["sql", "plpgsql"]
+
+# lowercase and collapse whitespace outside 'literals' and "quoted identifiers", then
+# drop the object's own schema and pg_catalog qualifiers outside 'literals'; an unquoted
+# qualifier can only name the object's schema if that schema is lowercase
+q_definition_digests = text(
+    definitions_cte
+    + r"""select object_type, object_schema, object_name, identity_arguments,
+       case when language = any(CAST(:normalized_languages AS text[])) then md5(btrim(coalesce(
+           (select string_agg(
+                case when s.is_literal then s.segment
+                else regexp_replace(
+                    s.segment,
+                    '(^|[^\w"])("' || regexp_replace(object_schema, '(\W)', '\\\1', 'g') || '"|'
+                        || case when object_schema = lower(object_schema)
+                           then regexp_replace(object_schema, '(\W)', '\\\1', 'g') || '|'
+                           else '' end
+                        || 'pg_catalog)\.',
+                    '\1', 'g') end,
+                '' order by s.literals, s.is_literal desc)
+            from (select t.literals, t.is_literal, string_agg(t.token, '' order by t.ord) as segment
+                  from (select m.ord, m.token[1] ~ '^''' as is_literal,
+                        count(*) filter (where m.token[1] ~ '^''') over (order by m.ord) as literals,
+                        case when m.token[1] ~ '^[''"]' then m.token[1]
+                        else regexp_replace(lower(m.token[1]), '\s+', ' ', 'g') end as token
+                        from regexp_matches(definition, :token_pattern, 'g')
+                            with ordinality as m(token, ord)) t
+                  group by t.literals, t.is_literal) s), '')))
+       else md5(definition) end as definition_digest
+       from definitions
+       order by object_type, object_schema, object_name, identity_arguments;""")
+
+q_definitions = text(
+    definitions_cte
+    + """select object_type, object_schema, object_name, identity_arguments, language, definition
+       from definitions
+       where (object_type, object_schema, object_name, identity_arguments) in (
+           select * from unnest(
+               CAST(:object_types AS text[]), CAST(:object_schemas AS text[]),
+               CAST(:object_names AS text[]), CAST(:identity_arguments AS text[])));""")